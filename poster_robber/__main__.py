@@ -1,56 +1,272 @@
-import pathlib
+import os
 import argparse
 import calendar
 import datetime as dt
+import time
 
-import pydantic
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs
 
 from .api import API, Transaction, ClientInfo
 
+# zstd заметно плотнее snappy по умолчанию, а разжимается не медленнее
+PARQUET_WRITE_OPTIONS = ds.ParquetFileFormat().make_write_options(
+    compression="zstd", compression_level=7
+)
 
-def df_store(fname, items: list[pydantic.BaseModel], key_field: str) -> pd.DataFrame:
-    data = [item.model_dump(by_alias=False) for item in items]
+# совпадает с pa.timestamp в arrow_schema моделей
+TIMESTAMP_DTYPE = np.dtype("datetime64[s]")
 
-    df = None
-    if data:
-        df = pd.DataFrame.from_records(data, index=key_field)
+# файлы отображаются в память вместо копирования в буферы
+MMAP_FS = pa.fs.LocalFileSystem(use_mmap=True)
 
-    if pathlib.Path(fname).exists():
-        loaded = pd.read_feather(fname)
 
-        if df is not None:
-            df = pd.concat([df, loaded])
-            df = df[~df.index.duplicated(keep="last")]
-        else:
-            df = loaded
+def drop_duplicates(table: pa.Table, key_field: str) -> pa.Table:
+    # оставляем последнюю версию записи: для каждого ключа берём
+    # наибольший номер строки и выбираем эти строки в исходном порядке
+    rows = pa.array(np.arange(table.num_rows))
+    last = (
+        table.select([key_field])
+        .append_column("row", rows)
+        .group_by(key_field)
+        .aggregate([("row", "max")])
+    )
+    last_rows = last["row_max"]
+    return table.take(last_rows.take(pc.sort_indices(last_rows)))
+
+
+def list_parts(fname) -> list[str]:
+    # куски дописываются по одному на каждое обновление, имя начинается
+    # со времени записи - после сортировки последняя версия записи идёт последней.
+    # Каталог читается одним scandir, пути сразу строками для pyarrow
+    try:
+        with os.scandir(fname) as entries:
+            return sorted(
+                entry.path
+                for entry in entries
+                if entry.name.startswith("part-") and entry.name.endswith(".parquet")
+            )
+    except FileNotFoundError:
+        return []
+
+
+def cast_to_schema(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    # старые куски могут хранить int64 и доли секунды. Доли секунды
+    # отбрасываются, как при записи через ArrowModel.to_arrow_batch,
+    # а переполнение id, как и при записи, - ошибка
+    return pa.Table.from_arrays(
+        [
+            pc.cast(
+                table.column(field.name),
+                options=pc.CastOptions(field.type, allow_time_truncate=True),
+            )
+            for field in schema
+        ],
+        schema=schema,
+    )
+
+
+def read_parts(
+    parts: list[str],
+    schema: pa.Schema,
+    key_field: str,
+    filter: ds.Expression | None = None,
+) -> pa.Table:
+    # каждый кусок читается в своей схеме и приводится к текущей
+    # (см. cast_to_schema), затем остаётся последняя версия каждой записи
+    tables = []
+    for part in parts:
+        fragment = ds.dataset(part, format="parquet", filesystem=MMAP_FS)
+        table = fragment.to_table(columns=schema.names, filter=filter)
+        tables.append(cast_to_schema(table, schema))
+
+    return drop_duplicates(pa.concat_tables(tables), key_field)
+
+
+def df_load(
+    fname,
+    schema: pa.Schema,
+    key_field: str,
+    sort_field: str,
+    filter: ds.Expression | None = None,
+    columns: list[str] | None = None,
+    dictionary_columns: tuple[str, ...] = (),
+) -> pd.DataFrame:
+    import_legacy_db(fname, schema, key_field, sort_field)
 
-    if df is None:
+    parts = list_parts(fname)
+    if not parts:
         raise Exception("Dataframe is empty")
 
-    df.to_feather(fname)
+    # читаются только нужные колонки, ключ и поле сортировки нужны всегда
+    if columns is not None:
+        columns = list(dict.fromkeys([key_field, sort_field, *columns]))
+        schema = pa.schema([schema.field(name) for name in columns])
+
+    # filter выполняется при сканировании: по статистикам row group'ов
+    # не подходящие куски файла даже не читаются.
+    # Дубли убираются уже после фильтра, поэтому считаем, что поле
+    # периода у записи не меняется между выгрузками.
+    table = read_parts(parts, schema, key_field, filter)
+
+    # колонки с часто повторяющимися значениями кодируются словарём
+    # (в pandas - Categorical): уникальные значения среза берутся по кодам
+    for name in dictionary_columns:
+        if name in table.column_names:
+            index = table.schema.get_field_index(name)
+            table = table.set_column(
+                index, name, table.column(name).dictionary_encode()
+            )
+
+    df = table.to_pandas()
+
+    # куски отсортированы каждый по отдельности, общий порядок нужен crr_per_period
+    df = df.sort_values(sort_field, kind="stable")
+
+    return df.set_index(key_field)
+
+
+def write_part(fname, table: pa.Table, sort_field: str):
+    # сортировка по времени даёт row group'ам узкие min/max,
+    # благодаря чему фильтр по периоду отсекает лишнее
+    table = table.sort_by(sort_field)
+
+    ds.write_dataset(
+        table,
+        base_dir=fname,
+        format="parquet",
+        basename_template=f"part-{time.time_ns()}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        max_rows_per_group=64_000,
+        file_options=PARQUET_WRITE_OPTIONS,
+    )
+
+
+def import_legacy_db(fname, schema: pa.Schema, key_field: str, sort_field: str):
+    # до перехода на куски parquet база хранилась одним feather-файлом
+    # с индексом по ключу. Он переносится один раз, пока кусков ещё нет,
+    # и сам не удаляется
+    legacy = os.path.splitext(fname)[0] + ".feater"
+    if list_parts(fname) or not os.path.exists(legacy):
+        return
+
+    df = pd.read_feather(legacy)
+    if key_field not in df.columns:
+        df = df.reset_index()
 
-    return df
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = cast_to_schema(table, schema)
+    write_part(fname, table, sort_field)
 
+    print(f"Imported {table.num_rows} rows from {legacy} into {fname}")
+
+
+def df_compact(fname, schema: pa.Schema, key_field: str, sort_field: str):
+    parts = list_parts(fname)
+    if len(parts) < 2:
+        return
+
+    # сливаем все куски в один без дублей. Новый кусок пишется до удаления
+    # старых и по имени идёт после них: если удаление прервётся,
+    # оставшиеся дубли всё равно уступят его версиям записей
+    table = read_parts(parts, schema, key_field)
+    write_part(fname, table, sort_field)
+
+    for part in parts:
+        os.remove(part)
+
+
+# когда кусков становится больше, store сливается в один кусок:
+# иначе полные выгрузки клиентов и пересекающиеся окна транзакций
+# копят дубли, и чтение растёт с числом запусков
+COMPACT_PARTS = 16
+
+
+def df_store(fname, table: pa.Table, key_field: str, sort_field: str):
+    if table.num_rows == 0:
+        return
 
-def update_transactions(txs: list[Transaction]) -> pd.DataFrame:
-    return df_store("transactions.feater", txs, "id")
+    # старая база переносится до записи нового куска,
+    # иначе после него она уже не будет импортирована
+    import_legacy_db(fname, table.schema, key_field, sort_field)
 
+    # пишем только новые записи отдельным куском, старые не трогаем
+    write_part(fname, table, sort_field)
 
-def unload_transactions_for_date_range(
-    api: API, date_from: dt.date, date_to: dt.date
+    if len(list_parts(fname)) > COMPACT_PARTS:
+        df_compact(fname, table.schema, key_field, sort_field)
+
+
+def period_filter(
+    field: str, date_from: dt.date | None, date_to: dt.date | None
+) -> ds.Expression | None:
+    filter = None
+    if date_from is not None:
+        filter = ds.field(field) >= pa.scalar(to_dtime(date_from))
+    if date_to is not None:
+        cond = ds.field(field) < pa.scalar(to_dtime(date_to))
+        filter = cond if filter is None else filter & cond
+
+    return filter
+
+
+TRANSACTIONS_DB = "transactions.parquet"
+CLIENTS_DB = "clients.parquet"
+
+
+def update_transactions(txs: list[Transaction]):
+    df_store(TRANSACTIONS_DB, Transaction.to_arrow_table(txs), "id", "closed_at")
+
+
+def load_transactions(
+    date_from: dt.date | None = None,
+    date_to: dt.date | None = None,
+    columns: list[str] | None = None,
 ) -> pd.DataFrame:
-    txs = api.iter_transactions(date_from, date_to, per_page=500)
-    return update_transactions(txs)
+    return df_load(
+        TRANSACTIONS_DB,
+        Transaction.arrow_schema,
+        "id",
+        "closed_at",
+        period_filter("closed_at", date_from, date_to),
+        columns,
+        # в основном покупают одни и те же клиенты
+        dictionary_columns=("client_id",),
+    )
 
 
-def update_clients(cls: list[ClientInfo]) -> pd.DataFrame:
-    return df_store("clients.feater", cls, "id")
+def unload_transactions_for_date_range(api: API, date_from: dt.date, date_to: dt.date):
+    batches = api.iter_transaction_batches(date_from, date_to, per_page=500)
+    table = pa.Table.from_batches(batches, schema=Transaction.arrow_schema)
+    df_store(TRANSACTIONS_DB, table, "id", "closed_at")
 
 
-def unload_clients(api: API) -> pd.DataFrame:
+def update_clients(cls: list[ClientInfo]):
+    df_store(CLIENTS_DB, ClientInfo.to_arrow_table(cls), "id", "activated_at")
+
+
+def load_clients(
+    date_from: dt.date | None = None,
+    date_to: dt.date | None = None,
+    columns: list[str] | None = None,
+) -> pd.DataFrame:
+    return df_load(
+        CLIENTS_DB,
+        ClientInfo.arrow_schema,
+        "id",
+        "activated_at",
+        period_filter("activated_at", date_from, date_to),
+        columns,
+    )
+
+
+def unload_clients(api: API):
     clients = api.get_clients()
-    return update_clients(clients)
+    update_clients(clients)
 
 
 def to_dtime(d: dt.date | dt.datetime) -> dt.datetime:
@@ -62,28 +278,51 @@ def to_dtime(d: dt.date | dt.datetime) -> dt.datetime:
         raise Exception("unsupported type")
 
 
-def command_ccr(
-    api_key: str, unload_data: bool, start_period: dt.date, end_period: dt.date
-):
-    assert start_period < end_period
-    previous_preiod_start = to_dtime(start_period - (end_period - start_period))
+def previous_period_start(start_period: dt.date, end_period: dt.date) -> dt.datetime:
+    return to_dtime(start_period - (end_period - start_period))
+
 
+def load_ccr_data(
+    api_key: str,
+    unload_data: bool,
+    previous_preiod_start: dt.datetime,
+    start_period: dt.date,
+    end_period: dt.date,
+) -> tuple[pd.DataFrame, pd.DataFrame]:
     if unload_data:
         assert api_key is not None
         api = API(api_key)
 
         print("Retrieve transactions")
-        df_tx = unload_transactions_for_date_range(
-            api, previous_preiod_start, end_period
-        )
+        unload_transactions_for_date_range(api, previous_preiod_start, end_period)
 
         print("Retrieve clients")
-        df_cl = unload_clients(api)
-    else:
-        df_tx = update_transactions([])
-        df_cl = update_clients([])
-
-    # print(len(df_tx), len(df_cl))
+        unload_clients(api)
+
+    # с диска читаем только нужные периоды
+    df_tx = load_transactions(start_period, end_period, columns=["client_id"])
+    df_cl = load_clients(previous_preiod_start, end_period, columns=[])
+
+    return df_tx, df_cl
+
+
+def crr_per_period(
+    tx_ts: np.ndarray,
+    tx_cid_codes: np.ndarray,
+    tx_cid_values: np.ndarray,
+    cl_ts: np.ndarray,
+    cl_id: np.ndarray,
+    prev_starts: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # tx_ts и cl_ts отсортированы (см. df_load): границы всех периодов
+    # находятся бинарным поиском за один вызов на каждую границу
+    tx_lo = np.searchsorted(tx_ts, starts)
+    tx_hi = np.searchsorted(tx_ts, ends)
+    cl_prev = np.searchsorted(cl_ts, prev_starts)
+    cl_lo = np.searchsorted(cl_ts, starts)
+    cl_hi = np.searchsorted(cl_ts, ends)
 
     # отбираем клиентов, которые были на начало периода
     # tx_in_prev_period = df_tx[
@@ -94,64 +333,125 @@ def command_ccr(
     # кто совершил покупку в прошлый период
     # CS = df_cl[df_cl.index.isin(tx_in_prev_period["client_id"].unique())]
 
-    # новые клиенты в предшествующем периоде
-    CS = df_cl[
-        (df_cl["activated_at"] >= previous_preiod_start)
-        & (df_cl["activated_at"] < to_dtime(start_period))
-    ]
-    # print(CS)
-
-    # отбираем транзакции, совершённые в заданные период
-    tx_in_period = df_tx[
-        (df_tx["closed_at"] >= to_dtime(start_period))
-        & (df_tx["closed_at"] < to_dtime(end_period))
-    ]
+    n_left = np.empty(len(starts), dtype=np.int64)
+    for i in range(len(starts)):
+        # новые клиенты в предшествующем периоде
+        CS = cl_id[cl_prev[i] : cl_lo[i]]
+
+        # id клиентов, которые совершили покупку в рассматриваемом периоде:
+        # client_id закодирован словарём: уникальные коды среза (узкие целые,
+        # работа пропорциональна срезу, а не размеру словаря) переводим в id
+        clients_with_buy = tx_cid_values[np.unique(tx_cid_codes[tx_lo[i] : tx_hi[i]])]
+
+        # ушедшие клиенты - которые не совершили покупки в рассматриваемом периоде
+        # id в CS уникальны после df_load, clients_with_buy - после np.unique
+        n_left[i] = np.count_nonzero(~np.isin(CS, clients_with_buy, assume_unique=True))
+
+    return cl_lo - cl_prev, n_left, cl_hi - cl_lo, tx_hi - tx_lo
+
+
+def ccr_for_periods(
+    df_tx: pd.DataFrame,
+    df_cl: pd.DataFrame,
+    periods: list[tuple[dt.date, dt.date]],
+) -> list[tuple[int, int, int, int]]:
+    # границы переводятся в datetime64 с единицами колонок один раз,
+    # дальше searchsorted сравнивает значения без приведения типов
+    starts = np.array([start for start, _ in periods], dtype=TIMESTAMP_DTYPE)
+    ends = np.array([end for _, end in periods], dtype=TIMESTAMP_DTYPE)
+    prev_starts = starts - (ends - starts)
+
+    tx_cid = df_tx["client_id"].array
+
+    stats = crr_per_period(
+        df_tx["closed_at"].values,
+        tx_cid.codes,
+        tx_cid.categories.values,
+        df_cl["activated_at"].values,
+        df_cl.index.values,
+        prev_starts,
+        starts,
+        ends,
+    )
 
-    # id клиентов, которые совершили покупку в рассматриваемом периоде
-    clients_with_buy = tx_in_period["client_id"].unique()
-    # print(clients_with_buy)
+    return list(zip(*stats))
 
-    # ушедшие клиенты - которые не совершили покупки в рассматриваемом периоде
-    cl_left = CS[~CS.index.isin(clients_with_buy)]
-    # print(cl_left)
 
+def print_ccr(
+    start_period: dt.date,
+    end_period: dt.date,
+    n_cs: int,
+    n_left: int,
+    n_cn: int,
+    n_tx: int,
+):
     print(f"Period: [{start_period}, {end_period})")
-    print("Clients at period start:", len(CS))
-    print("Clients left:", len(cl_left))
-
-    CN = df_cl[
-        (df_cl["activated_at"] >= to_dtime(start_period))
-        & (df_cl["activated_at"] < to_dtime(end_period))
-    ]
-
-    print("Clients new:", len(CN))
-    print("Transactions in period:", len(tx_in_period))
+    print("Clients at period start:", n_cs)
+    print("Clients left:", n_left)
+    print("Clients new:", n_cn)
+    print("Transactions in period:", n_tx)
 
-    if len(CS) == 0:
+    if n_cs == 0:
         print("No client no period start. May be no data? Skip period")
         return
 
-    CRR = (len(CS) - len(cl_left)) / len(CS)
+    CRR = (n_cs - n_left) / n_cs
 
     print(f"CRR: {CRR * 100:.2f}%")
 
 
+def command_ccr(
+    api_key: str, unload_data: bool, start_period: dt.date, end_period: dt.date
+):
+    assert start_period < end_period
+
+    df_tx, df_cl = load_ccr_data(
+        api_key,
+        unload_data,
+        previous_period_start(start_period, end_period),
+        start_period,
+        end_period,
+    )
+    [stats] = ccr_for_periods(df_tx, df_cl, [(start_period, end_period)])
+    print_ccr(start_period, end_period, *stats)
+
+
+def load_ccr_data_for_steps(
+    api_key: str, unload_data: bool, periods: list[tuple[dt.date, dt.date]]
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    # данные грузим один раз на все шаги, дальше все шаги считаются разом.
+    # Начала предшествующих периодов не убывают, самое раннее - у первого шага
+    return load_ccr_data(
+        api_key,
+        unload_data,
+        previous_period_start(*periods[0]),
+        periods[0][0],
+        periods[-1][1],
+    )
+
+
 def command_ccr_step_monthly(
     api_key: str, unload_data: bool, start_period: dt.date, end_period: dt.date
 ):
-    start_period = start_period.replace(day=1)
+    # начала месяцев от месяца start_period и раньше end_period
+    starts = pd.date_range(
+        start_period.replace(day=1), end_period - dt.timedelta(days=1), freq="MS"
+    )
+    ends = starts + pd.offsets.MonthBegin(1)
+    periods = list(zip(starts.date, ends.date))
 
-    while start_period < end_period:
-        current_end = start_period + dt.timedelta(
-            days=calendar.monthrange(start_period.year, start_period.month)[1]
-        )
+    if not periods:
+        return
+
+    df_tx, df_cl = load_ccr_data_for_steps(api_key, unload_data, periods)
 
+    stats = ccr_for_periods(df_tx, df_cl, periods)
+
+    for (start_period, current_end), period_stats in zip(periods, stats):
         print(calendar.month_name[start_period.month], start_period.year)
-        command_ccr(api_key, unload_data, start_period, current_end)
+        print_ccr(start_period, current_end, *period_stats)
         print()
 
-        start_period = current_end
-
 
 def command_ccr_step_daily(
     api_key: str,
@@ -160,18 +460,28 @@ def command_ccr_step_daily(
     end_period: dt.date,
     step: int,
 ):
+    periods = []
     while start_period < end_period:
         current_end = start_period + dt.timedelta(days=step)
+        periods.append((start_period, current_end))
+
+        start_period = current_end
+
+    if not periods:
+        return
 
+    df_tx, df_cl = load_ccr_data_for_steps(api_key, unload_data, periods)
+
+    stats = ccr_for_periods(df_tx, df_cl, periods)
+
+    for (start_period, current_end), period_stats in zip(periods, stats):
         # print(f"Period: [{start_period}, {current_end})")
-        command_ccr(api_key, unload_data, start_period, current_end)
+        print_ccr(start_period, current_end, *period_stats)
         print()
 
-        start_period = current_end
-
 
 def command_db_info():
-    df_tx = update_transactions([])
+    df_tx = load_transactions()
     print("Transactions count:", len(df_tx))
     print(
         "Transactions closed at min/max: {} / {}".format(
@@ -182,7 +492,7 @@ def command_db_info():
 
     print()
 
-    df_cl = update_clients([])
+    df_cl = load_clients()
     print("Clients count:", len(df_cl))
     print(
         "Clients activated at min/max: {} / {}".format(